@@ -3,11 +3,34 @@
 
 import argparse
 import fnmatch
+import functools
+import os
 import random
+import re
 import requests
 import sys
-import xml.etree.ElementTree as ET
-from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib3.util.retry import Retry
+
+# Prefer lxml if available, its tostring() serializes in C where the stdlib's is pure Python
+# lxml refuses characters that aren't allowed in XML, so Gracenote strings go through xml_safe() first
+try:
+    import lxml.etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+# Prefer orjson for parsing the (large) grid responses if available
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Optional on-disk cache for responses between runs (--cache)
+try:
+    import requests_cache
+except ImportError:
+    requests_cache = None
 
 # Get command-line options
 parser=argparse.ArgumentParser()
@@ -16,6 +39,7 @@ parser.add_argument("--postal", type=str)
 parser.add_argument("--country", type=str, default="CAN")
 parser.add_argument("--days", type=int, default=1)
 parser.add_argument("--output", "-o", type=str, help="Output file", default="gracenote.xml")
+parser.add_argument("--cache", type=str, help="Cache HTTP responses in this file, requires requests-cache")
 args=parser.parse_args()
 
 if args.lineup is None:
@@ -27,15 +51,17 @@ if args.postal is None:
 if args.country is None:
     print ("Missing argument: country")
     sys.exit(1)
+if args.cache is not None and requests_cache is None:
+    print ("--cache requires requests-cache, continuing without cache")
 
 # Filter channels
 # - Only these will be included in the output
-allowed_channels = [
+allowed_channels = {
     "CIIIDT",
     "CKCODT",
     "CICADT",
     "CITYDT"
-]
+}
 
 # Force series
 # - Fix for shows not having episode numbers, but should be treated as a series so that "record series" function works.
@@ -44,12 +70,45 @@ force_series = [
     "*News*",
     "CTV Your Morning"
 ]
+# All patterns compiled into one regex so each title is only matched once
+# Case-insensitive where the OS is (Windows), same as fnmatch.fnmatch()
+force_series_re = re.compile('|'.join(f"(?:{fnmatch.translate(pattern)})" for pattern in force_series) or "(?!)",    # (?!) never matches
+                             re.IGNORECASE if os.path.normcase('A') == 'a' else 0)
 
 BASE_URL = "https://tvlistings.gracenote.com/api/grid"
 HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:138.0) Gecko/20100101 Firefox/138.0',
     'Referer': 'https://tvlistings.gracenote.com/grid-affiliates.html?aid=gapzap'
 }
+MAX_WORKERS = 4     # Number of three-hour blocks fetched concurrently
+TIMEOUT = 30        # Seconds to wait for each request
+CACHE_EXPIRE = 1800 # Seconds to keep cached responses, unless the server says otherwise
+
+
+# Characters not allowed in XML 1.0 (control characters, NULs, unpaired surrogates)
+invalid_xml_re = re.compile("[^\x09\x0A\x0D\x20-\uD7FF\uE000-\uFFFD\U00010000-\U0010FFFF]")
+
+
+# Strip characters that aren't allowed in XML from text coming from Gracenote
+def xml_safe(text):
+    if text is None:
+        return None
+    return invalid_xml_re.sub("", str(text))
+
+
+# Check whether a title should be treated as a series
+# Cached since the same titles air many times over the listing period
+@functools.lru_cache(maxsize=4096)
+def is_forced_series(title):
+    return force_series_re.match(title) is not None
+
+
+# Parse ISO8601 UTC timestamp and convert to local timezone
+# Shared by generate_random_episode_num() and time_to_local(), which are both called with the same start time
+@functools.lru_cache(maxsize=4096)
+def utc_to_local(utc_timestamp):
+    utc_time = datetime.fromisoformat(utc_timestamp.replace("Z", "+00:00"))
+    return utc_time.astimezone()
 
 
 # Generate random episode number
@@ -64,9 +123,7 @@ def generate_random_episode_num(start_time, mode):
     #return f"{season}.{episode}.0"
 
     # Time-based
-    utc_time = datetime.strptime(start_time, "%Y-%m-%dT%H:%M:%SZ")
-    utc_time = utc_time.replace(tzinfo=timezone.utc)
-    dt = utc_time.astimezone()
+    dt = utc_to_local(start_time)
 
     hour = dt.hour
     minute = dt.minute
@@ -86,11 +143,7 @@ def generate_random_episode_num(start_time, mode):
 # Convert UTC timestamps to local timezone with whatever format
 def time_to_local(utc_timestamp):
     try:
-        utc_time = datetime.strptime(utc_timestamp, "%Y-%m-%dT%H:%M:%SZ")
-        utc_time = utc_time.replace(tzinfo=timezone.utc)
-        #print (utc_time.strftime("%Y-%m-%d %H:%M"))
-
-        local_dt = utc_time.astimezone()
+        local_dt = utc_to_local(utc_timestamp)
         return local_dt.strftime("%Y-%m-%d %H:%M")
 
     except Exception as e:
@@ -99,69 +152,110 @@ def time_to_local(utc_timestamp):
 
 # Convert ISO8601 timestamp to XMLTV format
 # Basically just drops everything that's not a number
+# Cached since one program's stop time is usually the next one's start time
+@functools.lru_cache(maxsize=4096)
 def time_to_xmltv(utc_timestamp):
     try:
-        utc_time = datetime.strptime(utc_timestamp, "%Y-%m-%dT%H:%M:%SZ")
-        utc_time = utc_time.replace(tzinfo=timezone.utc)
+        utc_time = datetime.fromisoformat(utc_timestamp.replace("Z", "+00:00"))
         return utc_time.strftime("%Y%m%d%H%M%S")
     except Exception as e:
         return "Unknown"
 
 
-# Send request to Gracenote API and return a list
+# Create a single HTTP session so connections to Gracenote are kept alive and reused
+# With --cache, responses are also cached on disk and revalidated with conditional GETs.
+# The SQLite backend shares one connection (check_same_thread=False) guarded by a lock, so the session is safe to share between workers.
+def make_session():
+    if requests_cache is not None and args.cache is not None:
+        session = requests_cache.CachedSession(args.cache, expire_after=CACHE_EXPIRE, cache_control=True)
+    else:
+        session = requests.Session()
+    session.headers.update(HEADERS)
+    # Retry connection errors and transient server errors, backing off 0s, 0.6s, 1.2s (urllib3 doesn't sleep before the first retry)
+    retries = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS, max_retries=retries)
+    session.mount("https://", adapter)
+    return session
+
+
+# Fetch a single three-hour block and return its list of channels, or None and an error message
+# This runs in a worker thread, so errors are returned for the caller to print rather than printed here
+def fetch_block(session, params):
+    try:
+        res = session.get(BASE_URL, params=params, timeout=TIMEOUT)
+    except requests.RequestException as e:
+        return None, f"Failed to fetch at {params['time']} - {e}"
+
+    if res.status_code == 200:
+        # Result contains a record for each channel that includes channel info and events (programs)
+        data = orjson.loads(res.content) if orjson else res.json()
+        return data.get('channels', []), None
+
+    return None, f"Failed to fetch at {params['time']} - HTTP {res.status_code}"
+
+
+# Send requests to Gracenote API and return a list, along with how many blocks failed out of the total
 def fetch_listings(lineup_id, postal_code, country, days):
     listings = []   # Start with empty list
+    failed = 0
+    now = datetime.now()
 
     # Find timestamp for start of today
-    day = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    day = now.replace(hour=0, minute=0, second=0, microsecond=0)
 
     # Calculate nearest three-hour block (rounded down).  This is when we'll start pulling EPG data.
-    nearest = (datetime.now().hour // 3) * 3
+    nearest = (now.hour // 3) * 3
 
     # Pull data in three-hour chunks
-    for hour in range(nearest, 24 * days, 3):
-#    for hour in range(19, 20):
-        ts = int((day + timedelta(hours=hour)).timestamp())
-
-        # Send query for this time range
-        params = {
-            "lineupId": lineup_id,
-            "timespan": "3",	# hours
-            "headendId": "lineupId",
-            "country": country,
-            "postalCode": postal_code,
-            "time": ts
-        }
-        res = requests.get(BASE_URL, params=params, headers=HEADERS)
-
-        if res.status_code == 200:
-            # Append JSON result to list.  Result contains a record for each channel that includes channel info and events (programs)
-            data = res.json()
-            listings.extend(data.get('channels', []))
-        else:
-            print (f"Failed to fetch at {ts} - HTTP {res.status_code}")
-
-    return listings
-
-
-def add_channel(channel, tv, added_channels):
+    timestamps = [int((day + timedelta(hours=hour)).timestamp()) for hour in range(nearest, 24 * days, 3)]
+
+    # Build query for each time range
+    params_list = [{
+        "lineupId": lineup_id,
+        "timespan": "3",	# hours
+        "headendId": "lineupId",
+        "country": country,
+        "postalCode": postal_code,
+        "time": ts
+    } for ts in timestamps]
+
+    # Requests are I/O bound, so send them concurrently.  map() keeps results in time order.
+    with make_session() as session, ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for channels, error in executor.map(lambda params: fetch_block(session, params), params_list):
+            if error is not None:
+                print (error)
+                failed += 1
+            else:
+                listings.extend(channels)
+
+    return listings, failed, len(params_list)
+
+
+# Serialize a finished element and append it to the output
+def write_element(out, element):
+    out.write(ET.tostring(element, encoding='unicode'))
+    out.write("\n")
+
+
+def add_channel(channel, out, added_channels):
     # Create XML entry for channel
     if channel['channelId'] in added_channels:
         return	# Already added, skip
 
-    xmlchannel = ET.SubElement(tv, 'channel', id = channel.get('callSign', channel.get('channelId')))    # Channel ID is callSign, fallback to channelID.
-    ET.SubElement(xmlchannel, 'display-name').text = channel.get('callSign', 'Unknown')
+    xmlchannel = ET.Element('channel', id = xml_safe(channel.get('callSign', channel.get('channelId'))))    # Channel ID is callSign, fallback to channelID.
+    ET.SubElement(xmlchannel, 'display-name').text = xml_safe(channel.get('callSign', 'Unknown'))
 
-    if "thumbnail" in channel:
-        if channel.get("thumbnail"):
-            ET.SubElement(xmlchannel, 'icon').text = f"src={channel.get('thumbnail')}"
+    if (thumbnail := channel.get("thumbnail")):
+        ET.SubElement(xmlchannel, 'icon').text = xml_safe(f"src={thumbnail}")
 
+    write_element(out, xmlchannel)
     added_channels.add(channel['channelId'])
 
 
-def add_program(event, channel_id, tv):
+def add_program(event, channel_id, out):
     # Create XML entry for program
-    prog = ET.SubElement(tv, 'programme', {
+    SubElement = ET.SubElement    # Local lookup, called several times per program
+    prog = ET.Element('programme', {
         'start': time_to_xmltv(event['startTime']),
         'stop': time_to_xmltv(event['endTime']),
         'channel': channel_id
@@ -170,66 +264,88 @@ def add_program(event, channel_id, tv):
     # Now we need to read the program object inside this event and extract data
     program = event.get('program')
     # can add lang='en' to all these subelements later
-    ET.SubElement(prog, 'title').text = program.get('title', 'No Title')
+    title = xml_safe(program.get('title', 'No Title'))
+    SubElement(prog, 'title').text = title
     # sub-title
     has_subtitle = False
-    if 'episodeTitle' in program:
-        if program.get('episodeTitle') is not None:
-            ET.SubElement(prog, 'sub-title').text = program.get('episodeTitle')
-            has_subtitle = True
+    if (episode_title := program.get('episodeTitle')) is not None:
+        SubElement(prog, 'sub-title').text = xml_safe(episode_title)
+        has_subtitle = True
     # desc
-    if 'shortDesc' in program:
-        if program.get('shortDesc') is not None:
-            ET.SubElement(prog, 'desc').text = program.get('shortDesc')
+    if (short_desc := program.get('shortDesc')) is not None:
+        SubElement(prog, 'desc').text = xml_safe(short_desc)
     # episode-num
-    if ('season' in program) and ('episode' in program):
-        if program.get('season') is not None and program.get('episode') is not None:
-            ET.SubElement(prog, 'episode-num', system='xmltv_ns').text = f"{program.get('season')}.{program.get('episode')}.0"
+    has_episode_num = False
+    if (season := program.get('season')) is not None and (episode := program.get('episode')) is not None:
+        SubElement(prog, 'episode-num', system='xmltv_ns').text = xml_safe(f"{season}.{episode}.0")
+        has_episode_num = True
 
     # If there is no episode number but this is overridden to be a series, we need to create an episode name and number.
-    if (prog.find('episode-num') is None):
-        for pattern in force_series:
-            if fnmatch.fnmatch(prog.find('title').text, pattern):
-                ET.SubElement(prog, 'episode-num', system='xmltv_ns').text = generate_random_episode_num(event['startTime'], "xmltv_ns_doy")
-                if not has_subtitle:
-                    ET.SubElement(prog, 'sub-title').text = time_to_local(event['startTime'])
+    if not has_episode_num:
+        if is_forced_series(title):
+            SubElement(prog, 'episode-num', system='xmltv_ns').text = generate_random_episode_num(event['startTime'], "xmltv_ns_doy")
+            if not has_subtitle:
+                SubElement(prog, 'sub-title').text = time_to_local(event['startTime'])
 
     # Identify movies in EPG
-    if ('seriesId' in program):
-        if program.get('seriesId') is not None:
-            category = program.get('seriesId')
-            if category.startswith('MV'):
-                ET.SubElement(prog, 'category').text = "Movie"
+    if (category := program.get('seriesId')) is not None:
+        if category.startswith('MV'):
+            SubElement(prog, 'category').text = "Movie"
 
-def main():
-    # Create main XML doc to hold results
-    tv = ET.Element('tv', {
-        'generator-info-name': 'gracenote-xmltv',
-        'generator-info-url': 'https://github.com/SolidElectronics/gracenote-xmltv.git'
-    })
+    write_element(out, prog)
 
+def main():
     added_channels = set()
 
     print("Fetching data from Gracenote...")
-    grid = fetch_listings(args.lineup, args.postal, args.country, args.days)
+    grid, failed, total = fetch_listings(args.lineup, args.postal, args.country, args.days)
+
+    # If nothing could be fetched (e.g. network is down), keep the previous guide rather than replacing it with an empty one.
+    # If only some blocks failed, the guide is still written with the data we have, same as the HTTP error case always did.
+    if failed == total:
+        print (f"No listings fetched, leaving {args.output} unchanged")
+        sys.exit(1)
+    if failed:
+        print (f"{failed} of {total} blocks failed, writing partial listings")
     print(f"Processing {len(grid)} channel blocks...")
 
-    # Add channels first so they're at the top of the file
+    # Group the allowed blocks by channel.  Each channel shows up once per three-hour block.
+    # callSigns are interned so every program shares one copy of the string.
+    by_callsign = {}
     for channel in grid:
         if channel['callSign'] in allowed_channels:
-            add_channel(channel, tv, added_channels)
-    print(f"Found {len(added_channels)} channels")
+            by_callsign.setdefault(sys.intern(channel['callSign']), []).append(channel)
 
-    # Then add programs
-    for channel in grid:
-        if channel['callSign'] in allowed_channels:
-            for event in channel.get('events', []):
-                add_program(event, channel['callSign'], tv)
-
-    # Write everything to output file as XML
+    # Write everything to output file as XML.  Each channel and program is written as soon as it's built so the whole document is never held in memory.
+    # Output goes to a temp file that replaces the real one only once it's complete, so a failure leaves the previous guide in place.
     print(f"Writing {args.output}...")
-    ET.ElementTree(tv).write(args.output, encoding='utf-8', xml_declaration=True)
-
+    tmp_output = args.output + ".tmp"
+    # Opened before the try so a failure to create it isn't followed by trying to remove it
+    out = open(tmp_output, 'w', encoding='utf-8')
+    try:
+        with out:
+            out.write("<?xml version='1.0' encoding='utf-8'?>\n")
+            out.write('<tv generator-info-name="gracenote-xmltv" generator-info-url="https://github.com/SolidElectronics/gracenote-xmltv.git">\n')
+
+            # Add channels first so they're at the top of the file
+            for blocks in by_callsign.values():
+                add_channel(blocks[0], out, added_channels)
+            print(f"Found {len(added_channels)} channels")
+
+            # Then add programs.  Programs that overlap two blocks are returned in both, so merge on start time and sort.
+            for callsign, blocks in by_callsign.items():
+                events = {}
+                for channel in blocks:
+                    for event in channel.get('events', []):
+                        events[event['startTime']] = event
+                for start_time in sorted(events):
+                    add_program(events[start_time], callsign, out)
+
+            out.write("</tv>\n")
+    except BaseException:
+        os.remove(tmp_output)
+        raise
+    os.replace(tmp_output, args.output)
 
 if __name__ == '__main__':
     main()